@@ -1,16 +1,21 @@
-import os, re, sys
-from telethon import errors
-from telethon.tl.functions.channels import JoinChannelRequest, GetFullChannelRequest
-from telethon.tl.functions.messages import GetHistoryRequest
-from telethon.tl.types import PeerChannel, MessageMediaPhoto, MessageMediaDocument, MessageMediaWebPage, User
+import os, re, sys, asyncio, hashlib, mmap, threading
+import requests
+from requests.adapters import HTTPAdapter
+from telethon import errors, utils
+from telethon.tl.functions.channels import JoinChannelRequest
+from telethon.tl.types import MessageMediaPhoto, MessageMediaDocument
 from telethon.errors import ChannelPrivateError, MediaCaptionTooLongError, SessionPasswordNeededError
 from telethon import TelegramClient, events
 from dotenv import load_dotenv
 from easygoogletranslate import EasyGoogleTranslate
 from pathlib import Path
-from deep_translator import GoogleTranslator
-from time import sleep
-from langdetect import detect
+from deep_translator import GoogleTranslator, google as google_translator
+from time import monotonic
+from langdetect import detect, detector_factory
+from functools import lru_cache
+from collections import deque
+from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
 import logging
 
 logging.basicConfig(stream=sys.stdout, level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
@@ -35,7 +40,33 @@ last_message = None
 last_adv = False
 adv_chat = None
 media_groups = {}
-translator = GoogleTranslator(source="auto", target='iw')
+media_groups_size = 64
+album_size = 10
+username_cache = {}
+username_cache_ttl = 3600
+username_cache_size = 1024
+chat_titles = {}
+sent_keys_file = 'sent_keys.bin'
+sent_keys_log = None
+sent_key_size = 16
+recent_sent = {}
+recent_sent_set = set()
+sent_window = 2048
+sent_log_records = 0
+joined_channels = set()
+join_task = None
+sent_history_limit = 256
+send_queues = {}
+send_workers = []
+send_rate = 20
+send_period = 60
+join_concurrency = 3
+flood_sleep_threshold = 120
+join_retries = 3
+lang_profiles = ['he', 'ar', 'en', 'fr', 'ru', 'es']
+translate_workers = 4
+translate_executor = ThreadPoolExecutor(max_workers=translate_workers, thread_name_prefix='translate')
+translator_local = threading.local()
 backup_translator = EasyGoogleTranslate()
 
 blocked_message = [
@@ -44,105 +75,127 @@ blocked_message = [
     'היכנסו למרחב המוגן',
     'חדירת כלי טיס עוין'
 ]
+url_pattern = re.compile(r'(?:https?://)?(?:t\.me|telegram\.me)/(?:joinchat/[\w-]+|[\w\d_]+/?|[\w\d_]+/\d+)')
+channel_pattern = re.compile(r'(?:https://t\.me/)?@?(?P<username>[a-zA-Z0-9_]+)$')
+script_patterns = {
+    'he': re.compile(r'[\u0590-\u05ff]'),
+    'ar': re.compile(r'[\u0600-\u06ff]'),
+    'en': re.compile(r'[A-Za-z]')
+}
+blocked_pattern = re.compile(r'(?<!\S)(' + '|'.join(map(re.escape, blocked_message)) + r')(?!\S)')
 
-arab_channels = [
-    '@a7rarjenin',
-    '@QudsN',
-    '@Electrohizbullah',
-    '@SerajSat',
-    '@shadysopoh',
-    '@jeninqassam',
-    '@Janin324',
-    '@jenin4',
-    '@anas_hoshia',
-    '@abohamzahasanat',
-    '@sarayajneen',
-    '@abohamzahasanat',
-    '@C_Military1',
-    '@mmirleb',
-    '@SabrenNews22',
-    '@IraninArabic',
-    '@iraninarabic_ir',
-    '@meshheek',
-    '@qassam1brigades',
-    '@qassambrigades',
-    '@duyuf1',
-    '@Ail_2_9',
-    '@alghalebun3',
-    '@areennabluss'
-]
+arab_channels = {
+    'a7rarjenin',
+    'qudsn',
+    'electrohizbullah',
+    'serajsat',
+    'shadysopoh',
+    'jeninqassam',
+    'janin324',
+    'jenin4',
+    'anas_hoshia',
+    'abohamzahasanat',
+    'sarayajneen',
+    'c_military1',
+    'mmirleb',
+    'sabrennews22',
+    'iraninarabic',
+    'iraninarabic_ir',
+    'meshheek',
+    'qassam1brigades',
+    'qassambrigades',
+    'duyuf1',
+    'ail_2_9',
+    'alghalebun3',
+    'areennabluss'
+}
 
-smart_channels = [
-    '@abualiexpress',
-    '@arabworld301',
-    '@AlealamAlearabiuEranMalca',
-    '@AsrarLubnan'
-]
+smart_channels = {
+    'abualiexpress',
+    'arabworld301',
+    'alealamalearabiueranmalca',
+    'asrarlubnan'
+}
+
+@dataclass(slots=True)
+class ForwardJob:
+    message: object
+    caption: str
+    target_chat_id: int
 
 if not all([api_id, api_hash, phone, arabs_chat, smart_chat]):
     raise ValueError("One or more environment variables are missing.")
 
 if dev:
-    client = TelegramClient('bot-dev', api_id, api_hash)
+    client = TelegramClient('bot-dev', api_id, api_hash, flood_sleep_threshold=flood_sleep_threshold, catch_up=True)
 else:
-    client = TelegramClient('bot', api_id, api_hash)
+    client = TelegramClient('bot', api_id, api_hash, flood_sleep_threshold=flood_sleep_threshold, catch_up=True)
+
+def load_lang_profiles():
+    profiles = []
+    for lang in lang_profiles:
+        with open(os.path.join(detector_factory.PROFILES_DIRECTORY, lang), 'r', encoding='utf-8') as f:
+            profiles.append(f.read())
+    factory = detector_factory.DetectorFactory()
+    factory.load_json_profile(profiles)
+    detector_factory._factory = factory
 
 def load_channels():
-    with open('arab_channels.txt', 'r') as f:
-        for line in f:
-            arab_channels.append(line.strip())
-    with open('smart_channels.txt', 'r') as f:
-        for line in f:
-            smart_channels.append(line.strip())
+    for channels, list_name in ((arab_channels, 'arab'), (smart_channels, 'smart')):
+        with open(f'{list_name}_channels.txt', 'r', encoding='utf-8') as f:
+            names = {name.strip().lstrip('@').lower() for name in f if name.strip()}
+        logger.info(f"Loaded {len(names)} channels from {list_name}_channels.txt, {len(names - channels)} new")
+        channels.update(names)
 
 async def join_channel(channel):
-    try:
-        if not await check_client_in_channel(channel):
-            await client(JoinChannelRequest(channel))
+    channel = channel.lstrip('@').lower()
+    if channel in joined_channels:
+        logger.info(f"The client is in the channel {channel}")
+        return
+    for attempt in range(join_retries):
+        try:
+            result = await client(JoinChannelRequest(channel))
+            for chat in result.chats:
+                cache_username(utils.get_peer_id(chat), chat)
+            joined_channels.add(channel)
             logger.info(f"Joined channel {channel}")
-    except errors.FloodWaitError as e:
-        sleep(e.seconds)
+            return
+        except errors.UserAlreadyParticipantError:
+            joined_channels.add(channel)
+            logger.info(f"The client is in the channel {channel}")
+            return
+        except errors.FloodWaitError as e:
+            logger.info(f"Flood wait of {e.seconds}s while joining {channel}")
+            await asyncio.sleep(e.seconds + 2 ** attempt)
+        except ChannelPrivateError:
+            logger.error(f"The channel {channel} is private or not accessible.")
+            return
+        except Exception as e:
+            logger.error(f"An error occurred: {e}")
+            return
+    logger.error(f"Gave up joining {channel} after {join_retries} flood waits")
 
 async def join_channels():
-    for channel in arab_channels + smart_channels:
-        channel = channel[1:] if channel.startswith('@') else channel
-        try:
-            if not await check_client_in_channel(channel):
-                await client(JoinChannelRequest(channel))
-                logger.info(f"Joined channel {channel}")
-        except errors.FloodWaitError as e:
-            sleep(e.seconds)
+    semaphore = asyncio.Semaphore(join_concurrency)
 
-async def check_client_in_channel(channel_username):
-    try:
-        channel = await client.get_entity(channel_username)
-        
-        full_channel = await client(GetFullChannelRequest(channel=channel))
+    async def join(channel):
+        async with semaphore:
+            await join_channel(channel)
 
-        if full_channel.full_chat.participants_count > 0:
-            logger.info(f"The client is in the channel {channel_username}")
-            return True
-        else:
-            logger.info(f"The client is not in the channel {channel_username}")
-            return False
-    except ChannelPrivateError:
-        logger.error(f"The channel {channel_username} is private or not accessible.")
-        return False
-    except Exception as e:
-        logger.error(f"An error occurred: {e}")
-        return False
+    await asyncio.gather(*(join(channel) for channel in arab_channels | smart_channels if channel not in joined_channels))
+    logger.info("Joined channels")
 
 async def general_handler(event):
     message = event.message
-    if (message.is_private):
-        logger.info(f"Received message from {message.chat.first_name}")
-    else:
-        logger.info(f"Received message from {message.chat.title}")
-    if message.chat_id == owner_id:
-        if dev:
-            await send_message_to_telegram_chat(message, arabs_chat)
-        if message.message.startswith("/"):
-            await command_handler(message.message.split(' ')[0].split('/')[1], message.chat_id, message.message.split(' ')[1:])
+    logger.info(f"Received message from {message.chat.first_name}")
+    if dev:
+        await send_message_to_telegram_chat(message, arabs_chat)
+    if message.message.startswith("/"):
+        command, *args = message.message[1:].split() or ['']
+        await command_handler(command, message.chat_id, args)
+
+async def sent_handler(event):
+    mark_as_sent(event.chat_id, event.message.message, event.message.media, persist=False)
 
 async def arab_handler(event):
     message = event.message
@@ -163,163 +216,308 @@ async def smart_handler(event):
     message = event.message
     await send_message_to_telegram_chat(message, smart_chat)
 
+def get_translator():
+    if not hasattr(translator_local, 'translator'):
+        translator_local.translator = GoogleTranslator(source="auto", target='iw')
+    return translator_local.translator
+
+def get_translate_session():
+    if not hasattr(translator_local, 'session'):
+        translator_local.session = requests.Session()
+        translator_local.session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=1))
+    return translator_local.session
+
+class TranslateRequests:
+    def get(self, *args, **kwargs):
+        return get_translate_session().get(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(requests, name)
+
+# deep_translator 1.11.4 (pinned in requirements.txt) calls requests.get from the
+# deep_translator.google module; recheck this when upgrading it
+google_translator.requests = TranslateRequests()
+
+@lru_cache(maxsize=4096)
+def translate(text):
+    try:
+        return get_translator().translate(text)
+    except Exception as e:
+        return backup_translator.translate(text, 'iw')
+
+@lru_cache(maxsize=4096)
+def detect_lang(text):
+    return detect(text)
+
+async def run_in_translate_executor(func, *args):
+    return await asyncio.get_running_loop().run_in_executor(translate_executor, func, *args)
+
+def quick_lang(text):
+    text = text[:256]
+    counts = {lang: len(pattern.findall(text)) for lang, pattern in script_patterns.items()}
+    if counts['he'] and counts['he'] * 5 >= len(text):
+        return 'he'
+    lang = max(counts, key=counts.get)
+    if counts[lang] * 2 > sum(counts.values()):
+        return lang
+    return None
+
 def is_blocked_message(message):
-    for blocked in blocked_message:
-        if blocked in message.split():
-            logger.info(f'Blocked message, cause: {blocked} - full message: {message}')
-            return True
+    if not message:
+        return False
+    match = blocked_pattern.search(message)
+    if match:
+        logger.info(f'Blocked message, cause: {match.group(1)} - full message: {message}')
+        return True
     return False
 
+def media_id(media):
+    document = getattr(media, 'photo', None) or getattr(media, 'document', None)
+    return getattr(document, 'id', None)
+
+def sent_keys(caption, media):
+    keys = []
+    if caption:
+        keys.append(hashlib.blake2b(caption.encode(), digest_size=sent_key_size).digest())
+    if media_id(media) is not None:
+        keys.append(hashlib.blake2b(f'media:{media_id(media)}'.encode(), digest_size=sent_key_size).digest())
+    return keys
+
+def mark_as_sent(target_chat_id, caption, media, persist=True):
+    global sent_log_records
+    for key in sent_keys(caption, media):
+        remember_recent(target_chat_id, key)
+        if persist:
+            sent_keys_log.write(target_chat_id.to_bytes(8, 'little', signed=True) + key)
+            sent_log_records += 1
+    if persist:
+        sent_keys_log.flush()
+        if sent_log_records >= 2 * sent_window * len(recent_sent):
+            compact_sent_keys()
+
+def remember_recent(target_chat_id, key):
+    item = (target_chat_id, key)
+    if item in recent_sent_set:
+        return
+    recent = recent_sent.setdefault(target_chat_id, deque(maxlen=sent_window))
+    if len(recent) == recent.maxlen:
+        recent_sent_set.discard((target_chat_id, recent[0]))
+    recent.append(key)
+    recent_sent_set.add(item)
+
+def load_sent_keys():
+    global sent_keys_log
+    record_size = 8 + sent_key_size
+    if os.path.exists(sent_keys_file) and os.path.getsize(sent_keys_file) % record_size:
+        # Drop a record torn by a crash so later appends stay aligned
+        os.truncate(sent_keys_file, os.path.getsize(sent_keys_file) // record_size * record_size)
+    if os.path.exists(sent_keys_file) and os.path.getsize(sent_keys_file) >= record_size:
+        with open(sent_keys_file, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            for offset in range(0, len(data) - record_size + 1, record_size):
+                target_chat_id = int.from_bytes(data[offset:offset + 8], 'little', signed=True)
+                remember_recent(target_chat_id, data[offset + 8:offset + record_size])
+    compact_sent_keys()
+
+def compact_sent_keys():
+    # Rewrite the log with only the keys still inside the dedup window
+    global sent_keys_log, sent_log_records
+    if sent_keys_log is not None:
+        sent_keys_log.close()
+    with open(f'{sent_keys_file}.tmp', 'wb') as f:
+        for target_chat_id, keys in recent_sent.items():
+            prefix = target_chat_id.to_bytes(8, 'little', signed=True)
+            f.write(b''.join(prefix + key for key in keys))
+    sent_log_records = sum(map(len, recent_sent.values()))
+    os.replace(f'{sent_keys_file}.tmp', sent_keys_file)
+    sent_keys_log = open(sent_keys_file, 'ab')
+
+async def load_sent_messages(target_chat_id):
+    async for message in client.iter_messages(target_chat_id, limit=sent_history_limit):
+        mark_as_sent(target_chat_id, message.message, message.media, persist=False)
+
 async def send_message_to_telegram_chat(message, target_chat_id):
     caption = await process_message(message)
-    if (await check_if_message_sent(target_chat_id, caption, message)):
+    if caption is None:
+        return
+    send_queues[target_chat_id].put_nowait(ForwardJob(message, caption, target_chat_id))
+
+async def send_worker(target_chat_id):
+    queue = send_queues[target_chat_id]
+    sent_times = deque(maxlen=send_rate)
+    while True:
+        job = await queue.get()
+        if len(sent_times) == send_rate and monotonic() - sent_times[0] < send_period:
+            await asyncio.sleep(send_period - (monotonic() - sent_times[0]))
+        try:
+            await deliver_message(job.message, job.target_chat_id, job.caption)
+            sent_times.append(monotonic())
+        except errors.FloodWaitError as e:
+            logger.info(f"Flood wait of {e.seconds}s while sending to {target_chat_id}")
+            await asyncio.sleep(e.seconds)
+            queue.put_nowait(job)
+        except Exception as e:
+            logger.error(f"An error occurred: {e}")
+        queue.task_done()
+
+async def deliver_message(message, target_chat_id, caption):
+    if check_if_message_sent(target_chat_id, caption, message):
         logger.error("Message already sent")
         return
-    chat_title = await client.get_entity(target_chat_id)
-    chat_title = chat_title.title if chat_title else target_chat_id
-    if (message.media != None and (type(message.media) == MessageMediaPhoto or type(message.media) == MessageMediaDocument)):
-        if type(message.media) == MessageMediaPhoto or (type(message.media) == MessageMediaDocument and message.media.video):
-            if (hasattr(message.media, "photo") and message.media.photo.dc_id > 1) or (hasattr(message.media, "document") and message.media.document.dc_id > 1):
-                await grouped_handler(message, target_chat_id, caption)
+    chat_title = chat_titles.get(target_chat_id)
+    if chat_title is None:
+        chat_title = getattr(await client.get_entity(target_chat_id), 'title', target_chat_id)
+        chat_titles[target_chat_id] = chat_title
+    media = message.media
+    if isinstance(media, (MessageMediaPhoto, MessageMediaDocument)):
+        is_photo = isinstance(media, MessageMediaPhoto)
+        if is_photo or media.video:
+            if (media.photo if is_photo else media.document).dc_id > 1:
+                if await grouped_handler(message, target_chat_id, caption):
+                    mark_as_sent(target_chat_id, caption, message.media)
                 return
-        elif type(message.media) == MessageMediaDocument:
-            await client.send_file(entity=target_chat_id, file=message.media.document, caption=caption)
+        else:
+            await client.send_file(entity=target_chat_id, file=media.document, caption=caption)
+            mark_as_sent(target_chat_id, caption, message.media)
             logger.info(f'Sent message with document to {chat_title}')
             return
     else:
         await client.send_message(entity=target_chat_id, message=caption, link_preview=False)
+        mark_as_sent(target_chat_id, caption, message.media)
         logger.info(f'Sent message to {chat_title}')
 
 
 async def grouped_handler(message, target_chat_id, caption):
-    grouped_message = await fetch_media_groups_as_objects(message)
-    if (grouped_message == 'working'):
-        return
+    if message.grouped_id is None:
+        album = [caption, message.media]
+    else:
+        album = await fetch_media_groups_as_objects(message)
+        if not album:
+            return False
+    files = album[1:] if len(album) > 2 else album[1]
+    chat_title = chat_titles.get(target_chat_id, target_chat_id)
     try:
-        chat_title = await client.get_entity(target_chat_id)
-        chat_title = chat_title.title if chat_title else target_chat_id
-        album = grouped_message[message.grouped_id]
-        if (album[0] == "sent"):
-            return
-        await client.send_file(entity=target_chat_id, file=album[1:], caption=grouped_message[message.grouped_id][0], link_preview=False)
-        grouped_message[message.grouped_id].append("sent")
-        grouped_message.pop(message.grouped_id)
-        logger.info(f'Sent message with photos to {chat_title}')
+        await client.send_file(entity=target_chat_id, file=files, caption=album[0], link_preview=False)
+    except MediaCaptionTooLongError:
+        sent_file = await client.send_file(entity=target_chat_id, file=files)
+        await client.send_message(entity=target_chat_id, message=caption, link_preview=False, reply_to=sent_file)
     except Exception as e:
-        if isinstance(e, MediaCaptionTooLongError):
-            sent_file = await client.send_file(entity=target_chat_id, file=grouped_message[message.grouped_id])
-            await client.send_message(entity=target_chat_id, message=caption, link_preview=False, reply_to=sent_file)
-            grouped_message.pop(message.grouped_id)
-            logger.info(f'Sent message with photos to {chat_title}')
-        else:
-            logger.error(f"An error occurred: {e} message link: {await get_message_link(message.chat_id, message.id)}")
+        logger.error(f"An error occurred: {e} message link: {await get_message_link(message.chat_id, message.id)}")
+        return False
+    media_groups.pop(message.grouped_id, None)
+    # The other messages of the album are still queued; marking every item is what makes them skip
+    for media in album[1:]:
+        mark_as_sent(target_chat_id, None, media)
+    logger.info(f'Sent message with photos to {chat_title}')
+    return True
 
 async def fetch_media_groups_as_objects(message):
-    global media_groups
-    offset_id = 0
-    limit = 30
-    chat = message.chat_id
-    if message.grouped_id in media_groups:
-        return 'working'
-    media_groups[message.grouped_id] = ['']
-    messages = await client.get_messages(chat, limit=limit, offset_id=offset_id)
+    # Siblings of one album share a single fetch instead of each reading the history
+    task = media_groups.get(message.grouped_id)
+    if task is None:
+        if len(media_groups) >= media_groups_size:
+            media_groups.pop(next(iter(media_groups)))
+        task = media_groups[message.grouped_id] = asyncio.ensure_future(load_media_group(message))
+    album = None
+    try:
+        album = await task
+    finally:
+        if album is None:
+            media_groups.pop(message.grouped_id, None)
+    return album
+
+async def load_media_group(message):
+    messages = await client.get_messages(message.chat_id, limit=2 * album_size, min_id=message.id - album_size, max_id=message.id + album_size)
     messages = [msg for msg in messages if msg.grouped_id == message.grouped_id]
     if not messages:
         return
-    for message in messages:
-        if message.grouped_id:
-            media_groups[message.grouped_id].append(message.media)
-            if message.message != '' and media_groups[message.grouped_id][0] == '':
-                caption = await process_message(message)
-                media_groups[message.grouped_id][0] = caption
-    return media_groups
+    album = ['']
+    for msg in messages:
+        album.append(msg.media)
+        if msg.message != '' and album[0] == '':
+            album[0] = await process_message(msg)
+    return album
 
 async def process_message(message):
-    global translator
-    url_pattern = re.compile(r'(https?://)?(t\.me|telegram\.me)/(joinchat/[\w-]+|[\w\d_]+/?|[\w\d_]+/\d+)')
-    caption = url_pattern.sub('', message.message)
+    caption = message.message
+    if 't.me/' in caption or 'telegram.me/' in caption:
+        caption = url_pattern.sub('', caption)
     if ((caption == '' and not message.file) or is_blocked_message(caption)):
         logger.info(f'Blocked message: {caption}')
         return
-    try:
-        lang = detect(caption)
-    except Exception as e:
-        lang = 'iw'
+    lang = quick_lang(caption) if caption.strip() else 'iw'
+    if lang is None:
+        try:
+            lang = await run_in_translate_executor(detect_lang, caption[:200])
+        except Exception as e:
+            lang = 'iw'
     try:
         if (lang != 'iw' and lang != 'he'):
-            caption = translator.translate(caption)
+            caption = await run_in_translate_executor(translate, caption)
     except Exception as e:
-        try:
-            caption = backup_translator.translate(caption, 'iw')
-        except Exception as e:
-            caption = "Couldn't translate message.\n" + caption
+        caption = "Couldn't translate message.\n" + caption
     link = await get_message_link(message.chat_id, message.id)
     caption += f'\n\n{link}'
     return caption
 
-async def add_channel(channel_id, list, list_name):
-    match = re.match(r'(https://t\.me/)?(?P<username>[a-zA-Z0-9_]+)', channel_id)
-    if match:
-        username = match.group('username')
-        list.append(f"@{username}")
-        await join_channel(username)
-    with open(f'{list_name}_channels.txt', 'a') as f:
+async def add_channel(channel_id, channels, list_name):
+    match = channel_pattern.match(channel_id)
+    if not match:
+        return
+    username = match.group('username').lower()
+    if username in channels:
+        return
+    channels.add(username)
+    await join_channel(username)
+    with open(f'{list_name}_channels.txt', 'a', encoding='utf-8') as f:
         f.write(f'{username}\n')
 
-def remove_channel(channel_id, list):
-    list.remove(channel_id)
+def remove_channel(channel_id, channels):
+    channels.discard(channel_id.lstrip('@').lower())
+
+async def remove_channel_command(chat_id, args):
+    remove_channel(args[0], arab_channels)
+
+async def list_channels_command(chat_id, args):
+    await client.send_message(chat_id, f'Arab channels: {arab_channels}\n\nSmart channels: {smart_channels}')
+
+async def help_command(chat_id, args):
+    await client.send_message(chat_id, 'Commands: add_channel_arab, add_channel_smart, remove_channel, list_channels')
+
+commands = {
+    "add_channel_arab": lambda chat_id, args: add_channel(args[0], arab_channels, "arab"),
+    "add_channel_smart": lambda chat_id, args: add_channel(args[0], smart_channels, "smart"),
+    "remove_channel": remove_channel_command,
+    "list_channels": list_channels_command,
+    "help": help_command,
+}
 
 async def command_handler(command, chat_id, args):
-    match command:
-        case "add_channel_arab":
-            await add_channel(args[0], arab_channels, "arab")
-        case "add_channel_smart":
-            await add_channel(args[0], smart_channels, "smart")
-        case "remove_channel":
-            remove_channel(args[0], arab_channels)
-        case "list_channels":
-            client.send_message(chat_id, f'Arab channels: {arab_channels}')
-            client.send_message(chat_id, f'Smart channels: {smart_channels}')
-        case "help":
-            client.send_message(chat_id, 'Commands: add_channel_arab, add_channel_smart, remove_channel, list_channels')
-        case _:
-            pass
+    handler = commands.get(command)
+    if handler:
+        await handler(chat_id, args)
+
+def cache_username(chat_id, entity):
+    username_cache.pop(chat_id, None)
+    if len(username_cache) >= username_cache_size:
+        username_cache.pop(next(iter(username_cache)))
+    username_cache[chat_id] = (monotonic(), getattr(entity, 'username', None))
+    return username_cache[chat_id]
 
 async def get_message_link(channel_username, message_id):
-    # Get the input entity for the channel
-    channel = await client.get_entity(channel_username)
+    # Resolve the channel username, reusing recent lookups
+    cached = username_cache.get(channel_username)
+    if cached is None or monotonic() - cached[0] > username_cache_ttl:
+        cached = cache_username(channel_username, await client.get_entity(channel_username))
     # Construct the message link
-    if hasattr(channel, 'username') and channel.username:
-        message_link = f"https://t.me/{channel.username}/{message_id}"
+    if cached[1]:
+        message_link = f"https://t.me/{cached[1]}/{message_id}"
         return message_link
     
-async def check_if_message_sent(channel_username, caption, message_obj):
-    try:
-        channel = await client.get_entity(channel_username)
-        history = await client(GetHistoryRequest(
-            peer=PeerChannel(channel.id),
-            limit=50,
-            offset_date=None,
-            offset_id=0,
-            max_id=0,
-            min_id=0,
-            add_offset=0,
-            hash=0
-        ))
-        for message in history.messages:
-            if message.media != None and message_obj.media != None:
-                if type(message.media) == type(message_obj.media):
-                    if message_obj.media == message.media:
-                        return True
-            if message.message:
-                if caption == message.message:
-                    return True
-        return False
-    except Exception as e:
-        logger.error(f"An error occurred: {e} message link: {await get_message_link(message.chat_id, message.id)}")
-        return False
+def check_if_message_sent(target_chat_id, caption, message_obj):
+    return any((target_chat_id, key) in recent_sent_set for key in sent_keys(caption, message_obj.media))
 
 async def main():
+    global join_task
     try:
         logger.info("Connecting to Telegram...")
         await client.start(phone=lambda: phone)
@@ -343,14 +541,25 @@ async def main():
         else:
             logger.info("Already authorized.")
         logger.info("Connected to Telegram successfully!")
+        load_lang_profiles()
+        logger.info("Loaded language profiles")
         if not dev:
             load_channels()
             logger.info("Loaded channels")
-            await join_channels()
-            logger.info("Joined channels")
-        client.add_event_handler(general_handler, events.NewMessage)
+        load_sent_keys()
+        for target_chat_id in (arabs_chat, smart_chat):
+            await load_sent_messages(target_chat_id)
+            send_queues[target_chat_id] = asyncio.Queue()
+            send_workers.append(asyncio.create_task(send_worker(target_chat_id)))
+        logger.info("Loaded sent messages")
+        client.add_event_handler(general_handler, events.NewMessage(chats=[owner_id]))
         client.add_event_handler(arab_handler, events.NewMessage(chats=arab_channels))
         client.add_event_handler(smart_handler, events.NewMessage(chats=smart_channels))
+        client.add_event_handler(sent_handler, events.NewMessage(chats=[arabs_chat, smart_chat]))
+        if not dev:
+            # Joins can sit in long flood waits, so they must not hold up forwarding
+            join_task = asyncio.create_task(join_channels())
+        await client.catch_up()
         await client.run_until_disconnected()
     except Exception as e:
         logger.error(f"An error occurred: {e}")